@@ -1,7 +1,13 @@
 """Docker Orchestration API code."""
 
-from typing import Any, ClassVar
-
+import asyncio
+import contextlib
+import logging
+import os
+from collections.abc import AsyncIterator
+from typing import Annotated, Any
+
+import orjson
 from docker_orchestrator import (
     VolumeMounts,
     docker_compose_run,
@@ -10,14 +16,29 @@ from docker_orchestrator import (
     update_file_on_remote_container,
     update_json_file_on_remote_container,
 )
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from sftp import close_connections, evict_idle_connections
+
+_LOGGER = logging.getLogger(__name__)
 
-APP = FastAPI()
+APP = FastAPI(default_response_class=ORJSONResponse)
 
 # List to store cached Docker contexts
-_DOCKER_CONTEXTS: dict[str, str]
+_DOCKER_CONTEXTS: dict[str, str] = {}
+
+# Cached Docker contexts serialised once for the /docker-contexts response
+_DOCKER_CONTEXTS_JSON = b"{}"
+
+# Media type a client accepts to get the inspect data one container per line
+_NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Seconds between two background reloads of the Docker contexts
+_CONTEXT_REFRESH_INTERVAL = int(os.environ.get("CONTEXT_REFRESH_INTERVAL", "60"))
+
+# Background task reloading the Docker contexts, kept to be cancelled on shutdown
+_CONTEXT_REFRESH_TASK: asyncio.Task[None] | None = None
 
 
 class UpdateFileRequest(BaseModel):
@@ -36,12 +57,10 @@ class UpdateFileRequest(BaseModel):
     container_id: str
     file_path: str
     file_content: str
-    context: ClassVar[str] = Field(..., description="Docker context name")
-
-    class Config:
-        """Configuration for the Pydantic model."""
+    context: str = Field(..., description="Docker context name")
 
-        schema_extra: ClassVar[dict[str, dict[str, str]]] = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "container_id": "container_id_123",
                 "file_path": "/path/to/file.txt",
@@ -49,6 +68,7 @@ class UpdateFileRequest(BaseModel):
                 "context": "my_docker_context",
             }
         }
+    )
 
 
 class UpdateJsonFileRequest(BaseModel):
@@ -72,10 +92,8 @@ class UpdateJsonFileRequest(BaseModel):
     merge_schema: dict | None = None
     context: str = Field(..., description="Docker context name")
 
-    class Config:
-        """Configuration for the Pydantic model."""
-
-        schema_extra: ClassVar[[str, str]] = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "container_id": "container_id_123",
                 "file_path": "/path/to/file.json",
@@ -84,6 +102,7 @@ class UpdateJsonFileRequest(BaseModel):
                 "context": "my_docker_context",
             }
         }
+    )
 
 
 class ComposeContent(BaseModel):
@@ -94,6 +113,11 @@ class ComposeContent(BaseModel):
     additional_args: str = Field(
         default="", description="Additional docker compose arguments"
     )
+    wait_timeout: int | None = Field(
+        default=None,
+        gt=0,
+        description="Seconds to wait for the services to be running or healthy",
+    )
 
 
 class ComposeContentWithFiles(BaseModel):
@@ -105,19 +129,84 @@ class ComposeContentWithFiles(BaseModel):
     additional_args: str = Field(
         default="", description="Additional docker compose arguments"
     )
+    wait_timeout: int | None = Field(
+        default=None,
+        gt=0,
+        description="Seconds to wait for the services to be running or healthy",
+    )
+
+
+async def _load_docker_contexts() -> None:
+    """Reload the cached Docker contexts.
+
+    The cache is left as it is if no context could be listed, e.g. when the
+    docker CLI failed, rather than rejecting every request until the next run.
+    """
+    global _DOCKER_CONTEXTS, _DOCKER_CONTEXTS_JSON  # noqa: PLW0603
+    contexts = await docker_context_ls()
+    if contexts or not _DOCKER_CONTEXTS:
+        _DOCKER_CONTEXTS = contexts
+        _DOCKER_CONTEXTS_JSON = orjson.dumps(contexts)
+
+
+async def _refresh_docker_contexts_periodically() -> None:
+    """Reload the cached Docker contexts every ``_CONTEXT_REFRESH_INTERVAL``.
+
+    Idle SSH connections are closed on the same schedule.
+    """
+    while True:
+        await asyncio.sleep(_CONTEXT_REFRESH_INTERVAL)
+        evict_idle_connections()
+        try:
+            await _load_docker_contexts()
+        except Exception:
+            # Keep the previous contexts and try again on the next run
+            _LOGGER.exception("Failed to reload the Docker contexts")
+
+
+@APP.on_event("startup")
+async def cache_docker_contexts() -> None:
+    """Cache the Docker contexts configured on the orchestrator.
+
+    Running this at startup populates the cache in every worker process, the
+    cache is then kept up to date by a background task.
+    """
+    global _CONTEXT_REFRESH_TASK  # noqa: PLW0603
+    await _load_docker_contexts()
+    _CONTEXT_REFRESH_TASK = asyncio.create_task(_refresh_docker_contexts_periodically())
+
+
+@APP.on_event("shutdown")
+async def stop_docker_contexts_refresh() -> None:
+    """Stop the background reload of the Docker contexts."""
+    if _CONTEXT_REFRESH_TASK is not None and not _CONTEXT_REFRESH_TASK.done():
+        _CONTEXT_REFRESH_TASK.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _CONTEXT_REFRESH_TASK
+
 
+@APP.on_event("shutdown")
+async def close_ssh_connections() -> None:
+    """Close the SSH connections kept open for copying mount files."""
+    await close_connections()
 
-@APP.post("/docker-compose")
-async def execute_docker_compose(content: ComposeContent) -> JSONResponse:
+
+@APP.post("/docker-compose", response_model=None)
+async def execute_docker_compose(
+    content: ComposeContent, queue: bool = True
+) -> ORJSONResponse:
     """Execute the Docker Compose on a target context.
 
     :param content: The Docker Compose YAML content with context details
     :type content: ComposeContent
+    :param queue: Queue behind a deployment already running on the context,
+                 otherwise fail straight away with 409 and a Retry-After header
+    :type queue: bool
     :raises HTTPException: If the context is already being used, or if the
                            context is not provided or YAML syntax is invalid
-    :return: Dictionary containing the stdout, stderr, and returncode
+    :return: ORJSONResponse containing the stdout, stderr, and returncode
              of the docker-compose command
-    :rtype: JSONResponse
+    :rtype: ORJSONResponse
     """
     # Check if the provided context is part of the cached Docker contexts
     if content.context not in _DOCKER_CONTEXTS:
@@ -127,15 +216,19 @@ async def execute_docker_compose(content: ComposeContent) -> JSONResponse:
     if not content.additional_args:
         content.additional_args = "--force-recreate --pull always --quiet-pull"
     result = await docker_compose_run(
-        content.yaml_content, content.context, additional_args=content.additional_args
+        content.yaml_content,
+        content.context,
+        additional_args=content.additional_args,
+        queue=queue,
+        wait_timeout=content.wait_timeout,
     )
-    return JSONResponse(content=result)
+    return ORJSONResponse(content=result)
 
 
-@APP.post("/docker-compose-with-mounts")
+@APP.post("/docker-compose-with-mounts", response_model=None)
 async def execute_docker_compose_with_mounts(
-    content: ComposeContentWithFiles,
-) -> JSONResponse:
+    content: ComposeContentWithFiles, queue: bool = True
+) -> ORJSONResponse:
     """Execute the Docker Compose command.
 
     The API accepts the following:
@@ -149,11 +242,14 @@ async def execute_docker_compose_with_mounts(
 
     :param content: The Docker Compose YAML content with context details
     :type content: ComposeContentWithFiles
+    :param queue: Queue behind a deployment already running on the context,
+                 otherwise fail straight away with 409 and a Retry-After header
+    :type queue: bool
     :raises HTTPException: If the context is already being used, or if the
                            context is not provided, or YAML syntax is invalid
-    :return: JSONResponse containing the stdout, stderr, and returncode
+    :return: ORJSONResponse containing the stdout, stderr, and returncode
              of the docker-compose command
-    :rtype: JSONResponse
+    :rtype: ORJSONResponse
     """
     # Check if the provided context is part of the cached Docker contexts
     if content.context not in _DOCKER_CONTEXTS:
@@ -168,42 +264,104 @@ async def execute_docker_compose_with_mounts(
         content.context,
         mounts=content.mounts,
         additional_args=content.additional_args,
+        queue=queue,
+        docker_host=_DOCKER_CONTEXTS[content.context],
+        wait_timeout=content.wait_timeout,
     )
-    return JSONResponse(content=result)
+    return ORJSONResponse(content=result)
+
 
+def _accepts_ndjson(accept: str | None) -> bool:
+    """Tell whether an Accept header explicitly asks for NDJSON.
 
-@APP.get("/inspect")
-async def inspect_containers_endpoint(context: str) -> dict[str, Any]:
+    :param accept: The Accept header of the request.
+    :type accept: str | None
+    :return: True if NDJSON is listed with a non-zero quality.
+    :rtype: bool
+    """
+    for media_range in (accept or "").split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        if media_type.lower() != _NDJSON_MEDIA_TYPE:
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+async def _ndjson_lines(data: dict[str, Any]) -> AsyncIterator[bytes]:
+    """Encode a dictionary as NDJSON, one single-key object per line.
+
+    An async generator, so Starlette doesn't hop to a thread for every line.
+
+    :param data: The dictionary to encode.
+    :type data: dict[str, Any]
+    :yield: The encoded lines.
+    :ytype: bytes
+    """
+    for key, value in data.items():
+        yield orjson.dumps({key: value}) + b"\n"
+
+
+@APP.get("/inspect", response_model=None)
+async def inspect_containers_endpoint(
+    context: str, accept: Annotated[str | None, Header()] = None
+) -> Response:
     """Inspect containers API endpoint.
 
     This endpoint allows inspecting all containers in the Docker Compose project
     associated with the specified Docker context. It returns a dictionary containing
     the container IDs as keys and their corresponding inspect data as values.
 
+    Clients sending ``Accept: application/x-ndjson`` get the data as one
+    ``{"<container>": <inspect data>}`` object per line instead, so they can
+    process it container by container.
+
     :param context: The Docker context associated with the Docker Compose project.
     :type context: str
+    :param accept: The Accept header of the request.
+    :type accept: str | None
     :raises HTTPException: If the context is already being used, or if the
                            context is not provided, or YAML syntax is invalid
-    :return: A dictionary containing the container IDs as keys and their
+    :return: Response containing the container IDs as keys and their
              corresponding inspect data as values
-    :rtype: dict[str, Any]
+    :rtype: Response
     """
     if context not in _DOCKER_CONTEXTS:
         raise HTTPException(status_code=400, detail="Invalid Docker context.")
 
-    return await docker_inspect_containers(context)
+    inspect_data = await docker_inspect_containers(context)
+    if _accepts_ndjson(accept):
+        return StreamingResponse(
+            _ndjson_lines(inspect_data), media_type=_NDJSON_MEDIA_TYPE
+        )
+    return ORJSONResponse(content=inspect_data)
 
 
-@APP.get("/docker-contexts")
-def list_docker_contexts() -> JSONResponse:
+@APP.get("/docker-contexts", response_model=None)
+def list_docker_contexts() -> Response:
     """Execute the Docker Context ls command and return configured context names.
 
     :return: Context list
-    :rtype: JSONResponse
+    :rtype: Response
+    """
+    return Response(content=_DOCKER_CONTEXTS_JSON, media_type="application/json")
+
+
+@APP.post("/docker-contexts/refresh", response_model=None)
+async def refresh_docker_contexts() -> Response:
+    """Reload the Docker contexts now, without waiting for the background refresh.
+
+    :return: Context list
+    :rtype: Response
     """
-    # Note: If we consider adding context via API, then maybe we won't
-    # need the cache.
-    return JSONResponse(content=_DOCKER_CONTEXTS)
+    await _load_docker_contexts()
+    return Response(content=_DOCKER_CONTEXTS_JSON, media_type="application/json")
 
 
 @APP.post("/update_file")
@@ -261,6 +419,4 @@ async def update_json_file(request_data: UpdateJsonFileRequest) -> dict[str, str
 if __name__ == "__main__":
     import uvicorn
 
-    # Cache Docker contexts at startup
-    _DOCKER_CONTEXTS = docker_context_ls()
     uvicorn.run(APP, host="0.0.0.0", port=8000, timeout_keep_alive=300)  # noqa: S104
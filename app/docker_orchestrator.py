@@ -1,28 +1,55 @@
 """Docker Orchestration code."""
 
 import asyncio
+import contextlib
 import json
-import subprocess
-import tempfile
-from functools import cache
-from pathlib import Path
+import os
+import re
+import shlex
+from collections import defaultdict, deque
+from functools import lru_cache
 from typing import Any
 from urllib.parse import urlparse
 
 import asyncssh
+import orjson
 import yaml
 from fastapi import HTTPException
-from jsonmerge import merge  # type: ignore[import-untyped]
+from jsonmerge import Merger  # type: ignore[import-untyped]
 from sftp import copy_files
 from typing_extensions import TypedDict
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # PyYAML built without LibYAML
+    from yaml import SafeLoader as _YamlLoader  # type: ignore[assignment]
+
 # Dictionary to store context locks
-_CONTEXT_LOCKS: dict[str, asyncio.Lock] = {}
+_CONTEXT_LOCKS: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
 
 # Dictionary to hold locks for each file in each container
-_FILE_LOCKS: dict[str, asyncio.Lock] = {}
+_FILE_LOCKS: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Seconds a client is asked to wait before retrying on a busy context
+_RETRY_AFTER = 10
+
+# Compose content larger than this (in characters) is parsed in a thread
+_PARSE_IN_THREAD_SIZE = 100 * 1024
+
+# Last successfully deployed Compose content for each context
+_COMPOSE_CACHE: dict[str, str] = {}
+
+# Contexts whose last deployed Compose content sets its own project name
+_NAMED_PROJECTS: set[str] = set()
+
+# Plain progress line printed by compose for every container that is up
+_CONTAINER_UP_PATTERN = re.compile(rb"Container (\S+)\s+(?:Started|Running)\b")
 
-_TMP_PATH = Path("/tmp/")  # noqa: S108
+# Trailing lines of each compose output stream returned to the client
+_OUTPUT_TAIL_LINES = int(os.environ.get("COMPOSE_OUTPUT_TAIL_LINES", "200"))
+
+# Longest single line (in bytes) read from the compose output streams
+_OUTPUT_LINE_LIMIT = 1024 * 1024
 
 
 class VolumeMounts(TypedDict):
@@ -57,17 +84,14 @@ async def copy_mount_files(
     :rtype: str
     :raises HTTPException: If there's an error copying the files over SSH.
     """
-    files_to_copy: list[tuple[str, str]] = []
+    files_to_copy: list[tuple[bytes, str]] = []
 
     for env_name, mount in mounts.items():
         # First replace the env_name in the YAML with the source path
         compose_config = compose_config.replace(env_name, mount["source"])
 
-        # Store the file in /tmp first before SFTP put.
-        file_name = Path(mount["source"]).name
-        Path(_TMP_PATH / file_name).write_text(mount["file"], encoding="utf-8")
-        temp_file = Path(_TMP_PATH / file_name)
-        files_to_copy.append(temp_file, mount["source"])
+        # The file content is written to the target straight from memory
+        files_to_copy.append((mount["file"].encode(), mount["source"]))
 
     try:
         ssh = urlparse(ssh_url)
@@ -85,51 +109,310 @@ async def copy_mount_files(
     return compose_config
 
 
-async def _get_compose_service_states(file_path: str, context: str) -> list[str]:
-    # Check if all containers were created
-    check_command = (
-        f"DOCKER_CONTEXT={context} docker "
-        f"compose --file={file_path} ps --format '{{{{.Names}}}}'"
+@lru_cache(maxsize=64)
+def _parse_compose(compose_content: str) -> tuple[bool, int]:
+    """Parse Compose content, telling whether it is named and counting services.
+
+    The result is cached, so content seen before is not parsed again.
+
+    :param compose_content: The Docker Compose content.
+    :type compose_content: str
+    :raises YAMLError: If the content is not a valid Compose document.
+    :return: Whether the content sets a top level ``name``, and the number
+             of services defined in the Compose content.
+    :rtype: tuple[bool, int]
+    """
+    compose_config = yaml.load(compose_content, Loader=_YamlLoader)
+    if not isinstance(compose_config, dict):
+        msg = "Compose content is not a mapping"
+        raise yaml.YAMLError(msg)
+    has_name = bool(compose_config.get("name"))
+    return has_name, len(compose_config.get("services") or {})
+
+
+@lru_cache(maxsize=32)
+def _get_merger(merge_schema: bytes) -> Merger:
+    """Return a jsonmerge Merger for a serialised merge schema.
+
+    :param merge_schema: The merge schema serialised with sorted keys.
+    :type merge_schema: bytes
+    :return: Merger built from the schema.
+    :rtype: Merger
+    """
+    return Merger(orjson.loads(merge_schema))
+
+
+def _merge_objects(base: Any, head: Any) -> Any:  # noqa: ANN401
+    """Merge head into base the way jsonmerge does without a schema.
+
+    Objects are merged recursively, any other value in head replaces the
+    one in base.
+
+    :param base: The existing JSON content.
+    :type base: Any
+    :param head: The JSON content to merge into base.
+    :type head: Any
+    :return: The merged JSON content.
+    :rtype: Any
+    """
+    if not isinstance(base, dict) or not isinstance(head, dict):
+        return head
+
+    merged = dict(base)
+    for key, value in head.items():
+        merged[key] = _merge_objects(base[key], value) if key in base else value
+    return merged
+
+
+def _merge_and_dump(
+    existing: bytes, json_content: dict, merge_schema: dict | None
+) -> bytes:
+    """Merge JSON content into the existing file content and serialise it.
+
+    The standard json module is used rather than orjson, which would turn
+    integers above 64 bits into floats and NaN into null, silently changing
+    the file, and rejects a UTF-8 BOM.
+
+    :param existing: The existing content of the JSON file.
+    :type existing: bytes
+    :param json_content: The JSON content to merge with the existing content.
+    :type json_content: dict
+    :param merge_schema: The merge schema to use for merging JSON content.
+    :type merge_schema: dict | None
+    :return: The merged JSON content.
+    :rtype: bytes
+    """
+    existing_content = json.loads(existing) if existing else {}
+
+    # Merge new JSON content into existing content using merge_schema if provided
+    if merge_schema:
+        merger = _get_merger(orjson.dumps(merge_schema, option=orjson.OPT_SORT_KEYS))
+        merged_content = merger.merge(existing_content, json_content)
+    else:
+        merged_content = _merge_objects(existing_content, json_content)
+
+    return json.dumps(merged_content, indent=4).encode()
+
+
+def _docker_env(context: str) -> dict[str, str]:
+    """Return the environment for a docker CLI process targeting a context.
+
+    Besides selecting the context, the CLI hints printed after some commands
+    are turned off, they are noise in the captured output.
+
+    :param context: The Docker context to run the command on.
+    :type context: str
+    :return: Environment variables for the docker process.
+    :rtype: dict[str, str]
+    """
+    return {**os.environ, "DOCKER_CONTEXT": context, "DOCKER_CLI_HINTS": "false"}
+
+
+async def _run_docker(
+    context: str,
+    *args: str | bytes,
+    stdin: bytes | None = None,
+    capture_stdout: bool = True,
+) -> tuple[int, bytes, bytes]:
+    """Run a docker CLI command against a context without going through a shell.
+
+    :param context: The Docker context to run the command on.
+    :type context: str
+    :param args: Arguments passed to the docker CLI.
+    :type args: str | bytes
+    :param stdin: Data to write to the command's stdin (optional).
+    :type stdin: bytes | None
+    :param capture_stdout: Collect the command's stdout, otherwise it is
+                           discarded and returned as empty bytes.
+    :type capture_stdout: bool
+    :return: The return code, stdout and stderr of the command.
+    :rtype: tuple[int, bytes, bytes]
+    """
+    stdin_pipe = (
+        asyncio.subprocess.DEVNULL if stdin is None else asyncio.subprocess.PIPE
+    )
+    stdout_pipe = (
+        asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL
+    )
+    process = await asyncio.create_subprocess_exec(
+        "docker",
+        *args,
+        env=_docker_env(context),
+        stdin=stdin_pipe,
+        stdout=stdout_pipe,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await process.communicate(input=stdin)
+    finally:
+        if process.returncode is None:
+            # Cancelled before docker exited, don't leave it running
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
+    return await process.wait(), stdout or b"", stderr
+
+
+async def _write_container_file(
+    context: str, container_id: str, file_path: str, data: bytes
+) -> tuple[int, bytes]:
+    """Overwrite a file inside a container with data piped to ``tee``.
+
+    The file is written in place, so it keeps its owner and mode.
+
+    :param context: The Docker context of the container.
+    :type context: str
+    :param container_id: The ID of the Docker container.
+    :type container_id: str
+    :param file_path: The path to the file inside the container.
+    :type file_path: str
+    :param data: The new content of the file.
+    :type data: bytes
+    :return: The return code and stderr of the docker exec command.
+    :rtype: tuple[int, bytes]
+    """
+    returncode, _, stderr = await _run_docker(
+        context,
+        "exec",
+        "--interactive",
+        container_id,
+        "tee",
+        # The path comes from the request, don't let it be read as an option
+        "--",
+        file_path,
+        stdin=data,
+        capture_stdout=False,
     )
+    return returncode, stderr
+
+
+def _project_name(context: str) -> str:
+    """Return the Compose project name used for a context.
+
+    It is used for Compose content that doesn't set its own ``name``. The
+    name follows the normalisation Compose applies to directory names, which
+    keeps it identical to the one derived from ``/tmp/<context>`` before.
+
+    :param context: The Docker context name.
+    :type context: str
+    :return: Compose project name.
+    :rtype: str
+    """
+    return re.sub(r"[^a-z0-9_-]", "", context.lower()).lstrip("_-")
+
+
+def _project_args(context: str, has_name: bool) -> list[str]:
+    """Return the compose arguments selecting the project of a context.
+
+    A ``name`` set in the Compose content is left to compose, which
+    interpolates and normalises it.
+
+    :param context: The Docker context name.
+    :type context: str
+    :param has_name: Whether the Compose content sets its own ``name``.
+    :type has_name: bool
+    :return: Compose CLI arguments.
+    :rtype: list[str]
+    """
+    return [] if has_name else [f"--project-name={_project_name(context)}"]
+
+
+async def _run_compose_up(
+    context: str, *args: str, stdin: bytes
+) -> tuple[int, bytes, bytes, int]:
+    """Run ``docker compose up`` while streaming its output line by line.
 
-    check_process = await asyncio.create_subprocess_shell(
-        check_command,
+    Only the last ``_OUTPUT_TAIL_LINES`` lines of each stream are kept, so
+    long image pulls don't pile up in memory. The containers reported as up
+    are counted while the output goes by.
+
+    :param context: The Docker context to run the command on.
+    :type context: str
+    :param args: Arguments passed to the docker CLI.
+    :type args: str
+    :param stdin: Compose content written to the command's stdin.
+    :type stdin: bytes
+    :return: The return code, the tails of stdout and stderr, and the number
+             of distinct containers that were started or already running.
+    :rtype: tuple[int, bytes, bytes, int]
+    """
+    process = await asyncio.create_subprocess_exec(
+        "docker",
+        *args,
+        env=_docker_env(context),
+        stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        limit=_OUTPUT_LINE_LIMIT,
     )
-    stdout, _ = await check_process.communicate()
-
-    # collect service status here
+    started: set[bytes] = set()
+
+    async def feed(stream: asyncio.StreamWriter | None) -> None:
+        if stream is None:
+            return
+        # Compose may exit before reading everything, e.g. on a bad argument
+        with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+            stream.write(stdin)
+            await stream.drain()
+        stream.close()
+
+    async def tail(stream: asyncio.StreamReader | None) -> bytes:
+        lines: deque[bytes] = deque(maxlen=_OUTPUT_TAIL_LINES)
+        too_long = False
+        at_eof = stream is None
+        while stream is not None and not at_eof:
+            try:
+                line = await stream.readuntil(b"\n")
+            except asyncio.LimitOverrunError as exc:
+                # Drop the buffered part of a line longer than the limit, the
+                # rest of it is dropped once its end is read
+                await stream.readexactly(exc.consumed)
+                too_long = True
+                continue
+            except asyncio.IncompleteReadError as exc:
+                line, at_eof = exc.partial, True
+            if too_long:
+                line, too_long = b"[line too long, dropped]\n", False
+            if line:
+                started.update(_CONTAINER_UP_PATTERN.findall(line))
+                lines.append(line)
+        return b"".join(lines)
 
-    if check_process.returncode != 0:
-        raise HTTPException(status_code=500, detail="Failed to check container status.")
-    return stdout.decode().strip().split("\n")
+    try:
+        _, stdout, stderr = await asyncio.gather(
+            feed(process.stdin), tail(process.stdout), tail(process.stderr)
+        )
+        return await process.wait(), stdout, stderr, len(started)
+    finally:
+        if process.returncode is None:
+            # Don't leave compose running unobserved, e.g. when the request
+            # is cancelled or reading its output failed
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
 
 
-@cache
-def docker_context_ls() -> dict[str, str]:
-    """Cache the docker context pre-configured on the orchestrator.
+async def docker_context_ls() -> dict[str, str]:
+    """List the docker contexts pre-configured on the orchestrator.
 
     :return: context names with their respective docker host URL.
     :rtype: dict[str, str]
     """
-    docker_context = {}
-
-    command = [
+    process = await asyncio.create_subprocess_exec(
         "docker",
         "context",
         "ls",
-        "--format",
-        "{{.Name}}|{{.DockerEndpoint}}",
-    ]
-    process = subprocess.run(command, capture_output=True, text=True, check=False)
-    if process.returncode == 0:
-        output = process.stdout.strip().splitlines()
-        for line in output:
-            context_name, docker_endpoint = line.split("|")
-            docker_context[context_name] = docker_endpoint
+        "--format={{json .}}",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        return {}
 
-    return docker_context
+    # One JSON object per context, one per line
+    contexts = (orjson.loads(line) for line in stdout.splitlines() if line)
+    return {context["Name"]: context["DockerEndpoint"] for context in contexts}
 
 
 async def docker_inspect_containers(context: str) -> dict[str, Any]:
@@ -138,7 +421,7 @@ async def docker_inspect_containers(context: str) -> dict[str, Any]:
     This function inspects all containers in the Docker Compose project
     associated with the specified Docker context. It collects the container
     details by running the `docker-compose ps` command to obtain the container
-    IDs, and then runs the `docker inspect` command for each container ID.
+    IDs, and then runs a single `docker inspect` command for all of them.
 
     :param context: The Docker context associated with the Docker Compose project.
     :type context: str
@@ -146,53 +429,127 @@ async def docker_inspect_containers(context: str) -> dict[str, Any]:
              corresponding inspect data as values.
     :rtype: dict[str, Any]
     """
-    file_path = f"/tmp/{context}/docker-compose.json"  # noqa: S108
+    # Feed the last deployed compose content through stdin, compose takes the
+    # project name from it. Without it, e.g. after a restart, compose still
+    # finds the project by the name derived from the context.
+    compose_content = _COMPOSE_CACHE.get(context)
+    if compose_content is not None:
+        project_args = _project_args(context, context in _NAMED_PROJECTS)
+        file_args = ["--file=-"]
+    else:
+        project_args = _project_args(context, has_name=False)
+        file_args = []
 
     # Run the docker-compose command asynchronously
-    command = (
-        f"DOCKER_CONTEXT={context} docker "
-        f"compose --file={file_path} ps --format '{{{{.Names}}}}'"
+    returncode, stdout, _ = await _run_docker(
+        context,
+        "compose",
+        *project_args,
+        *file_args,
+        "ps",
+        "--format={{.Names}}",
+        stdin=compose_content.encode() if compose_content is not None else None,
     )
-    process = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    stdout, _ = await process.communicate()
 
-    if process.returncode != 0:
+    if returncode != 0:
         # Return an empty dictionary if the command failed
         return {"error": "failed to execute docker compose inspect!"}
 
-    container_ids = stdout.decode().strip().split()
+    # The names are handed to docker inspect as they are, no need to decode
+    container_ids = stdout.split()
 
-    container_data: dict[str, Any] = {}
-    for container_id in container_ids:
-        command = f"DOCKER_CONTEXT={context} docker inspect {container_id}"
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, _ = await process.communicate()
-
-        if process.returncode == 0:
-            inspect_data = json.loads(stdout.decode().strip())
-            container_info: dict[str, str] = {}
-            if inspect_data:
-                container_info = inspect_data[0]
-            container_data[inspect_data[0]["Name"]] = container_info
-        else:
-            container_data[container_id] = "Failed to collect Data!!"
+    if not container_ids:
+        return {}
+
+    # A single docker inspect accepts all the IDs and returns a JSON array.
+    # If some of the containers are gone, docker still prints the ones it
+    # found and exits with a non-zero code.
+    returncode, stdout, _ = await _run_docker(context, "inspect", *container_ids)
+
+    inspect_data = orjson.loads(stdout) if stdout.strip() else []
+    container_data: dict[str, Any] = {entry["Name"]: entry for entry in inspect_data}
+
+    if returncode != 0:
+        found = {name.lstrip("/").encode() for name in container_data}
+        for container_id in container_ids:
+            if container_id not in found:
+                container_data[container_id.decode(errors="replace")] = (
+                    "Failed to collect Data!!"
+                )
 
     return container_data
 
 
-async def docker_compose_run(
+async def _prune_networks(context: str) -> None:
+    """Prune the docker networks on the target context before deploying.
+
+    All unused networks on the daemon are removed, not only the project's
+    own: leftovers of other or renamed projects may hold the fixed subnets
+    the Compose content asks for.
+
+    :param context: The target Docker context.
+    :type context: str
+    :raises HTTPException: If the docker network prune command fails.
+    """
+    returncode, _, stderr = await _run_docker(context, "network", "prune", "--force")
+    if returncode != 0:
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to execute docker network prune command.\n"
+            f"{stderr.decode(errors='replace')}",
+        )
+
+
+async def _copy_mounts_and_prune(
+    context: str,
+    compose_content: str,
+    mounts: dict[str, VolumeMounts],
+    docker_host: str,
+) -> str:
+    """Copy mount files to the target while its docker networks are pruned.
+
+    Both are independent, so they run concurrently.
+
+    :param context: The target Docker context.
+    :type context: str
+    :param compose_content: The Docker Compose content.
+    :type compose_content: str
+    :param mounts: File mounts for each service.
+    :type mounts: dict[str, VolumeMounts]
+    :param docker_host: docker host URL of the context.
+    :type docker_host: str
+    :return: The Compose content updated with the mount source paths.
+    :rtype: str
+    """
+    tasks = (
+        asyncio.create_task(
+            copy_mount_files(
+                mounts=mounts, compose_config=compose_content, ssh_url=docker_host
+            )
+        ),
+        asyncio.create_task(_prune_networks(context)),
+    )
+    try:
+        compose_content, _ = await asyncio.gather(*tasks)
+    finally:
+        # gather doesn't cancel the other task when one fails, make sure
+        # nothing is left writing to the target once the context lock is
+        # released
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+    return compose_content
+
+
+async def docker_compose_run(  # noqa: PLR0913
     compose_content: str,
     context: str,
     mounts: None | dict[str, VolumeMounts] = None,
     additional_args: None | str = "",
+    *,
+    queue: bool = True,
+    docker_host: str | None = None,
+    wait_timeout: int | None = None,
 ) -> dict[str, str | int]:
     """Run docker-compose command asynchronously with the specified context.
 
@@ -210,80 +567,110 @@ async def docker_compose_run(
     :param additional_args: additional compose cli args, example
                             ```--force-recreate --pull-always```
     :type additional_args: Optional[str]
-    :raises HTTPException: error code 400 if invalid Compose file provided.
-    :return: Dictionary containing the stdout, stderr, and returncode of
-             the docker-compose command.
+    :param queue: wait for a deployment already running on the context to
+                  finish, instead of failing with error code 409.
+    :type queue: bool
+    :param docker_host: docker host URL of the context, required to copy
+                        ```mounts``` to the target.
+    :type docker_host: str | None
+    :param wait_timeout: if set, wait up to this many seconds for the services
+                         to be running or healthy, and fail if they are not.
+    :type wait_timeout: int | None
+    :raises HTTPException: error code 400 if invalid Compose file provided or
+                           ```mounts``` are given without ```docker_host```,
+                           error code 409 if the context is busy and
+                           ```queue``` is False.
+    :return: Dictionary containing the last lines of stdout and stderr, and
+             the returncode of the docker-compose command.
     :rtype: dict[str, str|int]
     """
+    if mounts and docker_host is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Docker host of the context is unknown, cannot copy mounts.",
+        )
+
     # Acquire the lock for the context
-    context_lock = _CONTEXT_LOCKS.setdefault(context, asyncio.Lock())
+    context_lock = _CONTEXT_LOCKS[context]
+    if not queue and context_lock.locked():
+        raise HTTPException(
+            status_code=409,
+            detail="Docker context is already being used.",
+            headers={"Retry-After": str(_RETRY_AFTER)},
+        )
 
-    services_requested: dict
+    has_name: bool
+    services_requested: int
     async with context_lock:
-        # Check Compose syntax
+        # Check Compose syntax, large files are parsed off the event loop
         try:
-            compose_config = yaml.safe_load(compose_content)
-            services_requested = compose_config.get("services", {})
+            if len(compose_content) > _PARSE_IN_THREAD_SIZE:
+                has_name, services_requested = await asyncio.to_thread(
+                    _parse_compose, compose_content
+                )
+            else:
+                has_name, services_requested = _parse_compose(compose_content)
         except yaml.YAMLError as exc:
             raise HTTPException(status_code=400, detail="Invalid YAML syntax.") from exc
 
-        docker_host = docker_context_ls()[context]
-
-        # Copy files to be mounted to target destination
-        if mounts:
-            compose_content = await copy_mount_files(
-                mounts=mounts, compose_config=compose_content, ssh_url=docker_host
+        if mounts and docker_host is not None:
+            compose_content = await _copy_mounts_and_prune(
+                context, compose_content, mounts, docker_host
             )
+        else:
+            await _prune_networks(context)
 
-        # Save the Compose content to a temporary file
-        Path.mkdir(_TMP_PATH / context, exist_ok=True, parents=True)
-        file_path = Path(_TMP_PATH / context / "docker-compose.json")
-        Path(file_path).write_text(compose_content, encoding="utf-8")
-
-        # Prune the docker network on the target context before deploying
-        command = f"DOCKER_CONTEXT={context} docker network prune --force"
-        network_prune_process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        # Let compose wait for the services to be running or healthy
+        wait_args = (
+            ["--wait", f"--wait-timeout={wait_timeout}"]
+            if wait_timeout is not None
+            else []
         )
-        stdout, stderr = await network_prune_process.communicate()
-        if network_prune_process.returncode != 0:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to execute docker network prune command.\n"
-                f"{stderr.decode()}",
-            )
 
-        # Run docker-compose command asynchronously
-        command = (
-            f"DOCKER_CONTEXT={context} docker compose --file={file_path} "
-            f"up --detach --remove-orphans {additional_args}"
-        )
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        # Run docker-compose command asynchronously, the Compose content is
+        # streamed through stdin
+        returncode, stdout, stderr, services_started = await _run_compose_up(
+            context,
+            "compose",
+            "--ansi=never",
+            "--progress=plain",
+            # A name set in the Compose content wins, like it did when compose
+            # read the file from the project directory
+            *_project_args(context, has_name),
+            "--file=-",
+            "up",
+            "--detach",
+            "--remove-orphans",
+            *wait_args,
+            *shlex.split(additional_args or ""),
+            stdin=compose_content.encode(),
         )
-        stdout, stderr = await process.communicate()
 
-        if process.returncode != 0:
+        if returncode != 0:
             raise HTTPException(
                 status_code=500,
-                detail=f"Failed to execute docker-compose command.\n{stderr.decode()}",
+                detail="Failed to execute docker-compose command.\n"
+                f"{stderr.decode(errors='replace')}",
             )
 
-        container_ids = await _get_compose_service_states(str(file_path), context)
-        if len(container_ids) != len(services_requested):
+        if services_started != services_requested:
             raise HTTPException(
                 status_code=500,
                 detail="Invalid container creation count.",
             )
 
+        _COMPOSE_CACHE[context] = compose_content
+        if has_name:
+            _NAMED_PROJECTS.add(context)
+        else:
+            _NAMED_PROJECTS.discard(context)
+
+        # Decoded once here, orjson then writes the str as it is. Output that
+        # isn't valid UTF-8 must not turn a successful deploy into a 500.
         return {
-            "stdout": stdout.decode(),
-            "stderr": stderr.decode(),
-            "returncode": process.returncode,
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace"),
+            "returncode": returncode,
         }
 
 
@@ -304,59 +691,19 @@ async def update_file_on_remote_container(
     :return: A message indicating whether the file was updated successfully.
     :rtype: str
     """
-    temp_file = None
-
-    try:
-        # Create a temporary file to store the file content locally
-        temp_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        temp_file.write(file_content)
-        temp_file.close()
-
-        # Copy the temporary file into the container
-        copy_command = (
-            f"DOCKER_CONTEXT={context} docker cp "
-            f"{temp_file.name} {container_id}:{temp_file.name}"
-        )
-        copy_process = await asyncio.create_subprocess_shell(
-            copy_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await copy_process.communicate()
-
-        # Check if the command was successful
-        if copy_process.returncode != 0:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to copy temporary file to container: {stderr.decode()}",
-            )
+    returncode, stderr = await _write_container_file(
+        context, container_id, file_path, file_content.encode()
+    )
 
-        # Execute a command inside the container to overwrite the file
-        # with the temporary file
-        move_command = (
-            f"DOCKER_CONTEXT={context} docker exec {container_id} "
-            f"bash -c 'cat {temp_file.name} > {file_path}; rm {temp_file.name}'"
-        )
-        move_process = await asyncio.create_subprocess_shell(
-            move_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+    # Check if the command was successful
+    if returncode != 0:
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to update file inside container: "
+            f"{stderr.decode(errors='replace')}",
         )
-        _, stderr = await move_process.communicate()
 
-        # Check if the command was successful
-        if move_process.returncode != 0:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to update file inside container: {stderr.decode()}",
-            )
-
-        return f"File '{file_path}' updated successfully in container '{container_id}'"
-
-    finally:
-        # Cleanup: delete the temporary file if it still exists
-        if temp_file:
-            Path.unlink(Path(temp_file.name))
+    return f"File '{file_path}' updated successfully in container '{container_id}'"
 
 
 async def update_json_file_on_remote_container(
@@ -365,7 +712,7 @@ async def update_json_file_on_remote_container(
     json_content: dict,
     context: str,
     merge_schema: dict | None = None,
-) -> str:  # typing: ignore[too-many-local-variables]
+) -> str:
     """Update a JSON file inside a Docker container on a remote host by merging content.
 
     :param container_id: The ID of the Docker container.
@@ -382,84 +729,38 @@ async def update_json_file_on_remote_container(
     :return: A message indicating the success of the update operation.
     :rtype: str
     """
-    temp_file = None
-    file_lock = _FILE_LOCKS.setdefault(f"{container_id}-{file_path}", asyncio.Lock())
+    file_lock = _FILE_LOCKS[f"{container_id}-{file_path}"]
 
     async with file_lock:
-        try:
-            # Get existing JSON content from the file
-            command = (
-                f"DOCKER_CONTEXT={context} docker exec {container_id} cat {file_path}"
-            )
-            process = await asyncio.create_subprocess_shell(
-                command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-
-            if process.returncode != 0:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to read JSON file: {stderr.decode()}",
-                )
-
-            existing_content = json.loads(stdout.decode()) if stdout else {}
-
-            # Merge new JSON content into existing content using merge_schema if provided
-            if merge_schema:
-                merged_content = merge(existing_content, json_content, merge_schema)
-            else:
-                merged_content = merge(existing_content, json_content)
-
-            # Create a temporary file to store the merged JSON content locally
-            temp_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
-            temp_file.write(json.dumps(merged_content, indent=4))
-            temp_file.close()
+        # Get existing JSON content from the file
+        returncode, stdout, stderr = await _run_docker(
+            context, "exec", container_id, "cat", "--", file_path
+        )
 
-            # Copy the temporary file into the container
-            copy_command = (
-                f"DOCKER_CONTEXT={context} docker cp "
-                f"{temp_file.name} {container_id}:{temp_file.name}"
-            )
-            copy_process = await asyncio.create_subprocess_shell(
-                copy_command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
+        if returncode != 0:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to read JSON file: {stderr.decode(errors='replace')}",
             )
-            _, copy_stderr = await copy_process.communicate()
-
-            if copy_process.returncode != 0:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to copy temporary "
-                    f"file to container: {copy_stderr.decode()}",
-                )
 
-            # Execute a command inside the container to move the temporary file
-            # to the desired location and delete it
-            move_command = (
-                f"DOCKER_CONTEXT={context} docker exec {container_id} "
-                f"bash -c 'cat {temp_file.name} > {file_path}; rm {temp_file.name}'"
-            )
-            move_process = await asyncio.create_subprocess_shell(
-                move_command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-            _, move_stderr = await move_process.communicate()
+        # Parsing, merging and serialising large files is CPU bound, keep it
+        # off the event loop
+        merged_content = await asyncio.to_thread(
+            _merge_and_dump, stdout, json_content, merge_schema
+        )
 
-            if move_process.returncode != 0:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to update JSON file "
-                    f"inside container: {move_stderr.decode()}",
-                )
+        returncode, stderr = await _write_container_file(
+            context, container_id, file_path, merged_content
+        )
 
-            return (
-                f"JSON file '{file_path}' updated "
-                f"successfully in container '{container_id}'"
+        if returncode != 0:
+            raise HTTPException(
+                status_code=500,
+                detail="Failed to update JSON file "
+                f"inside container: {stderr.decode(errors='replace')}",
             )
 
-        finally:
-            # Cleanup: delete the temporary file
-            if temp_file:
-                Path.unlink(Path(temp_file.name))
+        return (
+            f"JSON file '{file_path}' updated "
+            f"successfully in container '{container_id}'"
+        )
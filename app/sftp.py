@@ -1,21 +1,135 @@
-"""Module to copy local files to target context using SFTP."""
+"""Module to copy files to target context using SFTP."""
 
 import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 
 import asyncssh
 
+_LOGGER = logging.getLogger(__name__)
+
 _ATTEMPTS_LIMIT = 3
 
+# Delay in seconds before the first retry, doubled for every further retry
+_RETRY_BACKOFF = 0.1
+
+# Size of each SFTP write request, OpenSSH rejects messages above 256 KiB
+_SFTP_BLOCK_SIZE = int(os.environ.get("SFTP_BLOCK_SIZE", "131072"))
+
+# Number of SFTP write requests kept in flight for each file
+_SFTP_MAX_REQUESTS = int(os.environ.get("SFTP_MAX_REQUESTS", "64"))
+
+# Seconds between SSH keepalive requests on pooled connections
+_KEEPALIVE_INTERVAL = 30
+
+# Maximum number of SSH connections kept open in the pool
+_SSH_POOL_SIZE = 16
+
+# Seconds an unused pooled SSH connection is kept open
+_SSH_IDLE_TIMEOUT = 300
+
+# SSH connections reused across copies, keyed by (host, username, port) and
+# ordered from least to most recently used
+_SSH_POOL: OrderedDict[tuple[str, str, int], asyncssh.SSHClientConnection] = (
+    OrderedDict()
+)
+
+# Locks serialising the connection setup for each pool key
+_SSH_POOL_LOCKS: defaultdict[tuple[str, str, int], asyncio.Lock] = defaultdict(
+    asyncio.Lock
+)
+
+# Number of copies currently using each pooled connection
+_SSH_POOL_USERS: defaultdict[tuple[str, str, int], int] = defaultdict(int)
+
+# Time each pooled connection was last released
+_SSH_POOL_LAST_USED: dict[tuple[str, str, int], float] = {}
+
+
+def _evict_connections() -> None:
+    """Close unused pooled connections that are idle or above the pool size."""
+    now = time.monotonic()
+    for key in list(_SSH_POOL):
+        if _SSH_POOL_USERS[key]:
+            continue
+        idle = now - _SSH_POOL_LAST_USED.get(key, now)
+        if len(_SSH_POOL) > _SSH_POOL_SIZE or idle > _SSH_IDLE_TIMEOUT:
+            _SSH_POOL.pop(key).close()
+            _SSH_POOL_LAST_USED.pop(key, None)
+
+
+@asynccontextmanager
+async def _pooled_connection(
+    ip_address: str, username: str, port: int
+) -> AsyncIterator[asyncssh.SSHClientConnection]:
+    """Borrow a pooled SSH connection, opening a new one if needed.
+
+    :param ip_address: Remote server IP address
+    :type ip_address: str
+    :param username: Remote server username
+    :type username: str
+    :param port: Remote server port
+    :type port: int
+    :yield: An open SSH connection to the remote server
+    :rtype: AsyncIterator[asyncssh.SSHClientConnection]
+    """
+    key = (ip_address, username, port)
+    _evict_connections()
+    async with _SSH_POOL_LOCKS[key]:
+        conn = _SSH_POOL.get(key)
+        if conn is None or conn.is_closed():
+            conn = await asyncssh.connect(
+                ip_address,
+                username=username,
+                port=port,
+                keepalive_interval=_KEEPALIVE_INTERVAL,
+            )
+            _SSH_POOL[key] = conn
+        _SSH_POOL.move_to_end(key)
+        _SSH_POOL_USERS[key] += 1
+
+    try:
+        yield conn
+    finally:
+        _SSH_POOL_USERS[key] -= 1
+        _SSH_POOL_LAST_USED[key] = time.monotonic()
+        _evict_connections()
+
+
+def evict_idle_connections() -> None:
+    """Close the pooled SSH connections that have been idle for too long.
+
+    Eviction also runs whenever a connection is borrowed or released, this
+    is for pools that have gone quiet.
+    """
+    _evict_connections()
+
+
+async def close_connections() -> None:
+    """Close all the pooled SSH connections."""
+    connections = list(_SSH_POOL.values())
+    _SSH_POOL.clear()
+    _SSH_POOL_LAST_USED.clear()
+    for conn in connections:
+        conn.close()
+    await asyncio.gather(*(conn.wait_closed() for conn in connections))
+
 
 async def copy_files(
-    files: list[tuple[str, str]], ip_address: str, username: str, port: int
+    files: list[tuple[bytes, str]], ip_address: str, username: str, port: int
 ) -> None:
-    """Copy multiple files from the local machine to the remote server.
+    """Copy multiple in-memory files to the remote server.
 
-    Files are copied over SSH using asyncssh.
+    Files are written using asyncssh, over a pooled SSH connection that is
+    reused by later copies to the same server until it has been idle for
+    a while.
 
-    :param files: The local path and remote path for each file
-    :type files: list[tuple[str, str]]
+    :param files: The file content and remote path for each file
+    :type files: list[tuple[bytes, str]]
     :param ip_address: Remote server IP address
     :type ip_address: str
     :param username: Remote server username
@@ -25,24 +139,45 @@ async def copy_files(
     """
 
     async def _copy_file(
-        local_path: str, remote_path: str, sftp: asyncssh.SFTPClient
+        data: bytes, remote_path: str, sftp: asyncssh.SFTPClient
     ) -> None:
         for attempt in range(_ATTEMPTS_LIMIT):
             try:
-                await sftp.put(local_path, remote_path)
+                async with sftp.open(
+                    remote_path,
+                    "wb",
+                    block_size=_SFTP_BLOCK_SIZE,
+                    max_requests=_SFTP_MAX_REQUESTS,
+                ) as remote_file:
+                    await remote_file.write(data)
                 return  # noqa: TRY300
             except asyncssh.Error as exc:
-                print(f"Error occurred while copying file: {exc}")  # noqa: T201
-                if attempt < _ATTEMPTS_LIMIT:
-                    await asyncio.sleep(1)
-                else:
+                _LOGGER.warning(
+                    "Error occurred while copying file %s (attempt %d/%d): %s",
+                    remote_path,
+                    attempt + 1,
+                    _ATTEMPTS_LIMIT,
+                    exc,
+                )
+                if attempt == _ATTEMPTS_LIMIT - 1:
                     raise
+                await asyncio.sleep(_RETRY_BACKOFF * 2**attempt)
 
     async with (
-        asyncssh.connect(ip_address, username=username, port=port) as conn,
+        _pooled_connection(ip_address, username, port) as conn,
         conn.start_sftp_client() as sftp,
-        asyncio.TaskGroup() as group,
     ):
-        for local_path, remote_path in files:
-            task = _copy_file(local_path, remote_path, sftp)
-            group.create_task(task)
+        tasks = [
+            asyncio.create_task(_copy_file(data, remote_path, sftp))
+            for data, remote_path in files
+        ]
+        # gather re-raises the asyncssh.Error itself, so callers can handle it
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # gather doesn't cancel the other copies when one fails, none may
+            # outlive the SFTP client or the pooled connection
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)